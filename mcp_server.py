@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 import asyncio
-import json
 import logging
 import os
-import sys
+import re
+import time
 import duckdb
+import pyarrow as pa
+import pyarrow.compute as pc
 from mcp.server import Server
 from mcp.server.models import InitializationOptions
 from mcp.server.stdio import stdio_server
@@ -16,198 +18,295 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DATABASE_PATH = "/app/data/database.duckdb"
+# Web UI のプロセスがDBファイルを開いている間は接続できないため、少し待って再試行する
+DB_LOCK_RETRIES = 20
+DB_LOCK_RETRY_INTERVAL = 0.05
+# MCPからの接続ではDBファイル以外のファイル・ネットワークへのアクセス（COPY TO、ATTACH、read_csvなど）を禁止し、
+# クエリから SET で設定を戻せないようにする
+DB_CONFIG = {"enable_external_access": False, "lock_configuration": True}
+
+# get_table_info の結果キャッシュの有効期間（秒）
+TABLE_INFO_CACHE_TTL = 30
+
+# LIMIT自動付与の判定用（クエリ全体の大文字化を避ける）
+_LIMIT_RE = re.compile(r"\bLIMIT\b", re.IGNORECASE)
+
+# Markdownの固定部品（区切り行は列数ごとに使い回す）
+_CODE_FENCE = "```"
+_SEP_CACHE: Dict[int, str] = {}
+
+def _quote_ident(name: str) -> str:
+    """SQL識別子としてダブルクオートで囲む"""
+    return '"' + name.replace('"', '""') + '"'
+
+def _separator_row(n: int) -> str:
+    """列数nのMarkdown区切り行を返す"""
+    sep = _SEP_CACHE.get(n)
+    if sep is None:
+        sep = _SEP_CACHE[n] = "|" + "|".join(["---"] * n) + "|"
+    return sep
+
+def _join_lines(rows: pa.ChunkedArray) -> str:
+    """行文字列の列を改行で連結し、1つのPython文字列として取り出す"""
+    lines = rows.combine_chunks()
+    offsets = pa.array([0, len(lines)], type=pa.int32())
+    return pc.binary_join(pa.ListArray.from_arrays(offsets, lines), "\n")[0].as_py()
+
+def _markdown_row_expr(columns: List[str]) -> str:
+    """各行をMarkdownの行文字列に整形するSQL式を組み立てる（NULLは"NULL"）"""
+    cells = ", ".join(f"COALESCE(CAST({_quote_ident(c)} AS VARCHAR), 'NULL')" for c in columns)
+    return f"'| ' || concat_ws(' | ', {cells}) || ' |'"
+
+# list_tools で返すツール定義（呼び出しごとに組み立て直さない）
+_TOOLS: List[Tool] = [
+    Tool(
+        name="execute_query", 
+        description="Execute a read-only SQL query against the local DuckDB database (the database is opened read-only with file and network access disabled, so statements that modify the database or read or write other files fail; temporary tables are discarded after each call). If the query has no LIMIT clause, you can optionally specify 'limit' to cap the number of returned rows (default: 100). The result is returned as a formatted table in text.",
+        inputSchema={
+            "type": "object",
+            "properties": {"query": {"type": "string"}, "limit": {"type": "integer"}},
+            "required": ["query"]
+        }
+    ),
+    Tool(
+        name="get_table_info",
+        description="Retrieve information about database tables. If 'table_name' is provided, returns detailed schema information (columns, data types, nullability, default values) and the row count for that table. If omitted, returns a list of all tables in the database with their row counts.",
+        inputSchema={
+            "type": "object",
+            "properties": {"table_name": {"type": "string"}},
+            "required": []
+        }
+    )
+]
 
 class LocalDBMCPServer:
     def __init__(self):
         self.server = Server("local-db-mcp-server")
         self.db_path = DATABASE_PATH
+        # table_name -> (取得時刻, 取得前のDBファイルの状態, get_table_infoの応答テキスト)
+        self._table_info_cache = {}
         self._setup_handlers()
 
     def _setup_handlers(self):
         @self.server.list_tools()
         async def handle_list_tools() -> List[Tool]:
-            return [
-                Tool(
-                    name="execute_query", 
-                    description="Execute a SQL query against the local DuckDB database. For SELECT statements, you can optionally specify 'limit' to cap the number of returned rows (default: 100). The result is returned as a formatted table in text.",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {"query": {"type": "string"}, "limit": {"type": "integer"}},
-                        "required": ["query"]
-                    }
-                ),
-                Tool(
-                    name="get_table_info",
-                    description="Retrieve information about database tables. If 'table_name' is provided, returns detailed schema information (columns, data types, nullability, default values) and the row count for that table. If omitted, returns a list of all tables in the database with their row counts.",
-                    inputSchema={
-                        "type": "object",
-                        "properties": {"table_name": {"type": "string"}},
-                        "required": []
-                    }
-                )
-            ]
+            return _TOOLS
+
+        # ツール名 -> 引数を受け取って処理するコルーチン関数（呼び出しごとに分岐しない）
+        tool_handlers = {
+            "execute_query": lambda arguments: self._execute_query(arguments.get("query"), arguments.get("limit", 100)),
+            "get_table_info": lambda arguments: self._get_table_info(arguments.get("table_name")),
+        }
 
         @self.server.call_tool()
         async def handle_call_tool(name: str, arguments: Dict[str, Any]) -> List[TextContent]:
-            if name == "execute_query":
-                query = arguments.get("query")
-                limit = arguments.get("limit", 100)
-                return await self._execute_query(query, limit)
-            elif name == "get_table_info":
-                table_name = arguments.get("table_name")
-                return await self._get_table_info(table_name)
-            else:
+            handler = tool_handlers.get(name)
+            if handler is None:
                 return [TextContent(type="text", text=f"Unknown tool: {name}")]
+            return await handler(arguments)
+
+    def _open_connection(self):
+        """読み取り専用でDuckDB接続を開く（書き込みはWeb UI側で行う）"""
+        # DBファイルがまだ無い場合は作成しておく
+        if not os.path.exists(self.db_path):
+            duckdb.connect(self.db_path).close()
+        for attempt in range(DB_LOCK_RETRIES):
+            try:
+                return duckdb.connect(self.db_path, read_only=True, config=DB_CONFIG)
+            except duckdb.IOException as e:
+                if "lock" not in str(e).lower() or attempt == DB_LOCK_RETRIES - 1:
+                    raise
+                time.sleep(DB_LOCK_RETRY_INTERVAL)
 
-    async def _get_connection(self):
+    def _with_connection(self, fn, *args):
+        """呼び出しごとにDuckDB接続を開いて fn(conn, *args) を実行し、終わったら閉じる
+        DuckDBは別プロセスが開いているDBファイルを開けないため、Web UIのプロセスと
+        交互に使えるよう接続を持ち続けない
+        """
         try:
-            return duckdb.connect(self.db_path)
+            conn = self._open_connection()
         except Exception as e:
             logger.error(f"Failed to connect to database: {e}")
             raise
+        try:
+            return fn(conn, *args)
+        finally:
+            conn.close()
+
+    def _db_file_state(self) -> tuple:
+        """DBファイルとWALの更新時刻・サイズ（キャッシュが古くなったかの判定用）"""
+        state = []
+        for path in (self.db_path, self.db_path + ".wal"):
+            try:
+                st = os.stat(path)
+                state.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                state.append(None)
+        return tuple(state)
+
+    def _count_rows(self, conn, table_names: List[str]) -> Dict[str, int]:
+        """複数テーブルの行数をUNION ALLの1クエリでまとめて取得"""
+        union = " UNION ALL ".join(
+            f"SELECT {i}, COUNT(*) FROM {_quote_ident(name)}" for i, name in enumerate(table_names)
+        )
+        try:
+            return {table_names[i]: count for i, count in conn.execute(union).fetchall()}
+        except Exception as e:
+            # 壊れたビューなどで失敗した場合はテーブルごとに取得し、失敗分は除外する
+            logger.warning(f"Batched row count failed, counting tables one by one: {e}")
+            row_counts = {}
+            for name in table_names:
+                try:
+                    row_counts[name] = conn.execute(f"SELECT COUNT(*) FROM {_quote_ident(name)}").fetchone()[0]
+                except Exception:
+                    pass
+            return row_counts
 
     async def _get_table_info(self, table_name: str = None) -> List[TextContent]:
         try:
             logger.info(f"Getting table info for: {table_name or 'all tables'}")
-            conn = await self._get_connection()
+            # Web UI側で書き込まれていればDBファイルかWALの状態が変わるので、キャッシュは使わない
+            db_state = self._db_file_state()
+            cached = self._table_info_cache.get(table_name)
+            if cached and time.monotonic() - cached[0] < TABLE_INFO_CACHE_TTL and cached[1] == db_state:
+                return [TextContent(type="text", text=cached[2])]
             
-            if table_name:
-                # 特定のテーブルの詳細情報を取得
-                # テーブルが存在するかチェック
-                tables_result = conn.execute("SHOW TABLES").fetchall()
-                table_names = [row[0] for row in tables_result]
-                
-                if table_name not in table_names:
-                    conn.close()
-                    return [TextContent(type="text", text=f"Table '{table_name}' not found.\nAvailable tables: {', '.join(table_names) if table_names else 'none'}")]
-                
-                # テーブルの詳細情報を取得
-                columns_info = conn.execute(f"DESCRIBE {table_name}").fetchall()
-                row_count = conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
-                
-                # テーブルコメントを取得
-                try:
-                    table_comment_result = conn.execute(f"SELECT comment FROM duckdb_tables() WHERE table_name = '{table_name}'").fetchone()
-                    table_comment = table_comment_result[0] if table_comment_result and table_comment_result[0] else ""
-                except:
-                    table_comment = ""
-                
-                # カラムコメントを取得
-                try:
-                    column_comments_result = conn.execute(f"""
-                        SELECT column_name, comment 
-                        FROM duckdb_columns() 
-                        WHERE table_name = '{table_name}' AND comment IS NOT NULL
-                    """).fetchall()
-                    column_comments = {row[0]: row[1] for row in column_comments_result}
-                except:
-                    column_comments = {}
-                
-                response = [f"## Table: {table_name}\n"]
-                if table_comment:
-                    response.append(f"**Description**: {table_comment}\n")
-                response.append(f"**Row count**: {row_count:,}\n")
-                response.append("### Columns\n")
-                response.append("```")
-                response.append("| Column | Data Type | Nullable | Default | Description |")
-                response.append("|----------|----------|----------|---------|-------------|")
-                
-                for col in columns_info:
-                    col_name = col[0]
-                    col_type = col[1]
-                    nullable = "YES" if col[2] else "NO"
-                    default = col[3] if col[3] is not None else ""
-                    comment = column_comments.get(col_name, "")
-                    response.append(f"| {col_name} | {col_type} | {nullable} | {default} | {comment} |")
-                
-                response.append("```")
-                
-            else:
-                # 全テーブルの一覧を取得
-                tables_result = conn.execute("SHOW TABLES").fetchall()
-                
-                if not tables_result:
-                    conn.close()
-                    return [TextContent(type="text", text="No tables in the database.")]
-                
-                response = ["## Tables in database\n"]
-                response.append("```")
-                response.append("| Table | Rows | Description |")
-                response.append("|------------|------|-------------|")
-                
-                for table_row in tables_result:
-                    table_name = table_row[0]
-                    try:
-                        row_count = conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
-                        
-                        # テーブルコメントを取得
-                        try:
-                            table_comment_result = conn.execute(f"SELECT comment FROM duckdb_tables() WHERE table_name = '{table_name}'").fetchone()
-                            table_comment = table_comment_result[0] if table_comment_result and table_comment_result[0] else ""
-                        except:
-                            table_comment = ""
-                        
-                        response.append(f"| {table_name} | {row_count:,} | {table_comment} |")
-                    except Exception as e:
-                        response.append(f"| {table_name} | ERROR | |")
-                
-                response.append("```")
-                response.append("\nTo get details for a specific table, provide the `table_name` parameter.")
-            
-            conn.close()
-            logger.info("Table info retrieved successfully")
-            return [TextContent(type="text", text="\n".join(response))]
+            # DuckDBの処理はイベントループを止めないよう別スレッドで実行する
+            return await asyncio.to_thread(self._with_connection, self._build_table_info, table_name, db_state)
             
         except Exception as e:
             logger.error(f"Error getting table info: {e}")
             return [TextContent(type="text", text=f"Failed to get table information: {str(e)}")]
 
-    async def _execute_query(self, query: str, limit: int) -> List[TextContent]:
-        try:
-            logger.info(f"Executing query: {query[:100]}...")
-            conn = await self._get_connection()
+    def _build_table_info(self, conn, table_name: str = None, db_state: tuple = None) -> List[TextContent]:
+        """get_table_info の本体（DB用スレッドで実行）"""
+        if table_name:
+            # 特定のテーブルの詳細情報を取得
+            # テーブルコメントとカラム情報（コメント込み）は1クエリでまとめて取得する
+            [(table_comment, columns_info)] = conn.execute("""
+                SELECT
+                    (SELECT comment FROM duckdb_tables()
+                      WHERE database_name = current_database()
+                        AND schema_name = current_schema()
+                        AND table_name = ?),
+                    list(struct_pack(name := column_name, type := data_type, nullable := is_nullable,
+                                     default_value := column_default, comment := comment)
+                         ORDER BY column_index)
+                FROM duckdb_columns()
+                WHERE database_name = current_database()
+                  AND schema_name = current_schema()
+                  AND table_name = ?
+            """, [table_name, table_name]).fetchall()
             
-            # SELECT文にLIMITを追加
-            if query.strip().upper().startswith("SELECT") and "LIMIT" not in query.upper():
-                query = f"{query.rstrip(';')} LIMIT {limit}"
-                logger.info(f"Added LIMIT {limit} to SELECT query")
+            # カラムが取れなければテーブルが存在しない
+            if not columns_info:
+                table_names = [row[0] for row in conn.execute("SHOW TABLES").fetchall()]
+                return [TextContent(type="text", text=f"Table '{table_name}' not found.\nAvailable tables: {', '.join(table_names) if table_names else 'none'}")]
             
-            result = conn.execute(query).fetchall()
-            columns = [desc[0] for desc in conn.description] if conn.description else []
-            conn.close()
+            row_count = conn.execute(f"SELECT COUNT(*) FROM {_quote_ident(table_name)}").fetchone()[0]
             
-            logger.info(f"Query executed successfully, returned {len(result)} rows")
+            response = [f"## Table: {table_name}\n"]
+            if table_comment:
+                response.append(f"**Description**: {table_comment}\n")
+            response.append(f"**Row count**: {row_count:,}\n")
+            response.append("### Columns\n")
+            response.append("```")
+            response.append("| Column | Data Type | Nullable | Default | Description |")
+            response.append("|----------|----------|----------|---------|-------------|")
             
-            if not result:
-                return [TextContent(type="text", text="No results")]
+            for col in columns_info:
+                nullable = "YES" if col["nullable"] else "NO"
+                default = col["default_value"] if col["default_value"] is not None else ""
+                comment = col["comment"] or ""
+                response.append(f"| {col['name']} | {col['type']} | {nullable} | {default} | {comment} |")
             
-            # テーブル形式で表示
-            response = [f"## Query Results ({len(result)} rows)\n"]
             response.append("```")
-            response.append("| " + " | ".join(columns) + " |")
-            response.append("|" + "|".join(["---"] * len(columns)) + "|")
             
-            for row in result:
-                formatted_row = []
-                for value in row:
-                    if value is None:
-                        formatted_row.append("NULL")
-                    else:
-                        formatted_row.append(str(value))
-                response.append("| " + " | ".join(formatted_row) + " |")
+        else:
+            # 全テーブルの一覧とコメントを1クエリで取得
+            tables_result = conn.execute("""
+                SELECT t.name, d.comment
+                FROM (SHOW TABLES) t
+                LEFT JOIN duckdb_tables() d
+                  ON d.table_name = t.name
+                 AND d.database_name = current_database()
+                 AND d.schema_name = current_schema()
+                ORDER BY t.name
+            """).fetchall()
+            
+            if not tables_result:
+                return [TextContent(type="text", text="No tables in the database.")]
             
+            row_counts = self._count_rows(conn, [row[0] for row in tables_result])
+            
+            response = ["## Tables in database\n"]
             response.append("```")
+            response.append("| Table | Rows | Description |")
+            response.append("|------------|------|-------------|")
+            
+            for name, table_comment in tables_result:
+                row_count = row_counts.get(name)
+                if row_count is None:
+                    response.append(f"| {name} | ERROR | |")
+                else:
+                    response.append(f"| {name} | {row_count:,} | {table_comment or ''} |")
             
-            return [TextContent(type="text", text="\n".join(response))]
+            response.append("```")
+            response.append("\nTo get details for a specific table, provide the `table_name` parameter.")
+        
+        logger.info("Table info retrieved successfully")
+        text = "\n".join(response)
+        self._table_info_cache[table_name] = (time.monotonic(), db_state, text)
+        return [TextContent(type="text", text=text)]
+
+    async def _execute_query(self, query: str, limit: int) -> List[TextContent]:
+        try:
+            logger.info(f"Executing query: {query[:100]}...")
+            # 更新系の文は読み取り専用の接続でDuckDBが拒否する
+            return await asyncio.to_thread(self._with_connection, self._run_query, query, limit)
             
         except Exception as e:
             logger.error(f"Error executing query '{query[:50]}...': {e}")
             return [TextContent(type="text", text=f"Query execution failed: {str(e)}")]
 
+    def _run_query(self, conn, query: str, limit: int) -> List[TextContent]:
+        """execute_query の本体（DB用スレッドで実行）"""
+        rel = conn.sql(query)
+        # SET などの結果を返さない文
+        if rel is None:
+            return [TextContent(type="text", text="No results")]
+        # LIMITが無ければ追加（クエリ文字列は書き換えずリレーションに適用するので、WITHやSHOWなどにも効く）
+        if not _LIMIT_RE.search(query):
+            rel = rel.limit(limit)
+            logger.info(f"Added LIMIT {limit} to query")
+        columns = rel.columns
+        # DuckDBは識別子を大文字小文字を区別せずに解決するので、重複も区別せずに判定する
+        if len({c.lower() for c in columns}) != len(columns):
+            # 列名が重複していると列を参照できないので、結果を受け取ってから位置で列名を付け直す
+            renamed = rel.fetch_arrow_table().rename_columns([f"c{i}" for i in range(len(columns))])
+            rel = conn.from_arrow(renamed)
+        # 行の整形はDuckDB側で行い、整形済みの文字列だけを受け取る（値の文字列化はどの文でもCAST AS VARCHARに揃える）
+        rows = rel.select(_markdown_row_expr(rel.columns)).fetch_arrow_table().column(0)
+        
+        logger.info(f"Query executed successfully, returned {len(rows)} rows")
+        
+        if not rows:
+            return [TextContent(type="text", text="No results")]
+        
+        # テーブル形式で表示
+        header = [
+            f"## Query Results ({len(rows)} rows)\n",
+            _CODE_FENCE,
+            "| " + " | ".join(columns) + " |",
+            _separator_row(len(columns)),
+        ]
+        
+        # 行の連結もArrow側で行い、行ごとのPython文字列を作らない
+        text = "\n".join((*header, _join_lines(rows), _CODE_FENCE))
+        return [TextContent(type="text", text=text)]
+
     async def run(self):
-        if not os.path.exists(self.db_path):
-            conn = duckdb.connect(self.db_path)
-            conn.close()
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
 
         async with stdio_server() as (read_stream, write_stream):
             await self.server.run(
@@ -227,4 +326,10 @@ async def main():
     await server.run()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop があればイベントループに使う（stdioの読み書きも速くなる）
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
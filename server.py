@@ -5,18 +5,29 @@ MCP Server with DuckDB
 """
 
 import asyncio
+import codecs
+import io
 import json
 import logging
+import re
 import urllib.parse
 import tempfile
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 import duckdb
+import orjson
+import pyarrow as pa
 import time
 from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Body
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import uvicorn
@@ -25,107 +36,422 @@ import uvicorn
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ORJSONResponse(JSONResponse):
+    """orjsonでシリアライズするJSONレスポンス（Decimalなど未対応の型はjsonable_encoderで変換）"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            default=jsonable_encoder,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        )
+
+# DuckDB接続
+DB_PATH = "/app/data/database.duckdb"
+# メモリに収まらない処理の退避先（DBファイルと同じボリュームに置く）
+DB_TEMP_DIR = os.path.join(os.path.dirname(DB_PATH), "tmp")
+# 取り込み中に自動チェックポイントが走らないようWALの閾値を大きめにとる
+CHECKPOINT_THRESHOLD = "1GB"
+
+# アップロードを一時ファイルへコピーする際のバッファサイズ
+UPLOAD_CHUNK_SIZE = 1 << 20
+# 文字コード判定に使う先頭バイト数
+ENCODING_SNIFF_SIZE = 64 * 1024
+# UTF-8以外のファイルをメモリ上で変換する上限サイズ（超える場合は一時ファイルを使う）
+IN_MEMORY_TRANSCODE_LIMIT = 32 << 20
+
+# /query でArrow IPCストリームを返す際のメディアタイプ
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+# Arrowを経由するとJSONの値が fetchall() と変わってしまう型
+# （HUGEINT/UHUGEINTの桁あふれ、INTERVAL・MAP・BITなどの表現の違い）
+_ARROW_JSON_UNSAFE_TYPE_RE = re.compile(r"\b(U?HUGEINT|INTERVAL|MAP|BIT|UNION|BIGNUM|VARINT)\b")
+
+# DuckDB接続の設定（CSV読み込みなどを全コアで並列実行する。
+# 自動チェックポイントは大きな取り込みの途中で走らないようにし、取り込み後に明示的に行う）
+DB_CONFIG = {
+    "threads": os.cpu_count() or 1,
+    "checkpoint_threshold": CHECKPOINT_THRESHOLD,
+    "temp_directory": DB_TEMP_DIR,
+}
+# MCPサーバーのプロセスがDBファイルを開いている間は接続できないため、少し待って再試行する
+DB_LOCK_RETRIES = 20
+DB_LOCK_RETRY_INTERVAL = 0.05
+
+# DuckDBの処理を実行するスレッド数
+DB_EXECUTOR_WORKERS = 5
+
+# 書き込み系エンドポイントを直列化するロック
+_write_lock = asyncio.Lock()
+
+# メタデータキャッシュの有効期間（秒）
+META_CACHE_TTL = 30
+# (種別, テーブル名) -> (取得時刻, レスポンス)
+_meta_cache: Dict[tuple, tuple] = {}
+# キャッシュを破棄するたびに進める世代番号（取得中に破棄された古い結果を保存しないために使う）
+_meta_cache_generation = 0
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """起動時にDuckDB用のスレッドとテーブル名の集合を用意し、終了時にスレッドを止める"""
+    app.state.db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="duckdb")
+    # _resolve_table_name で参照するテーブル名の集合（書き込み系エンドポイントで更新する）
+    try:
+        async with open_db() as conn:
+            app.state.table_names = await run_db(_load_table_names, conn)
+    except duckdb.Error as e:
+        # 読み込めなくても、名前解決で見つからなかったときに読み直すので起動は続ける
+        logger.warning(f"起動時にテーブル一覧を取得できませんでした: {e}")
+        app.state.table_names = set()
+    try:
+        yield
+    finally:
+        app.state.db_executor.shutdown(wait=True)
+
+class SkipDownloadGZipMiddleware(GZipMiddleware):
+    """DBファイルのダウンロード（/download/）だけは圧縮せずにそのまま返すGZipMiddleware
+    （圧縮するとsendfileとRangeリクエストが使えなくなる）"""
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http" and scope["path"].startswith("/download/"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
 # FastAPIアプリケーション
-app = FastAPI(title="Local DB MCP Server", version="1.0.0")
+app = FastAPI(
+    title="Local DB MCP Server",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
+# JSON は繰り返しが多く圧縮が効くので、小さめのレスポンスから軽めのレベルで圧縮する
+app.add_middleware(SkipDownloadGZipMiddleware, minimum_size=500, compresslevel=5)
 
 # 静的ファイルとテンプレートの設定
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-# DuckDB接続
-DB_PATH = "/app/data/database.duckdb"
+def _connect() -> duckdb.DuckDBPyConnection:
+    """DuckDB接続を開く（別プロセスがDBファイルをロックしている間は少し待って再試行する）"""
+    for attempt in range(DB_LOCK_RETRIES):
+        try:
+            conn = duckdb.connect(DB_PATH, config=DB_CONFIG)
+            break
+        except duckdb.IOException as e:
+            if "lock" not in str(e).lower() or attempt == DB_LOCK_RETRIES - 1:
+                raise
+            time.sleep(DB_LOCK_RETRY_INTERVAL)
+    # サーバーでは不要な進捗表示は切る
+    conn.execute("PRAGMA disable_progress_bar")
+    return conn
+
+async def run_db(fn, *args):
+    """DuckDBの処理（同期関数）をDB用スレッドで実行し、イベントループを塞がないようにする"""
+    return await asyncio.get_running_loop().run_in_executor(app.state.db_executor, fn, *args)
+
+@asynccontextmanager
+async def open_db():
+    """リクエストの間だけDuckDB接続を開く
+    DuckDBはファイルを開いているプロセス以外からの接続を拒むため、接続を持ち続けず
+    使い終わったら閉じてMCPサーバーのプロセスがDBファイルを開けるようにする
+    （同じプロセス内の同時接続はDuckDBが1つのデータベースインスタンスを共有する）
+    """
+    conn = await run_db(_connect)
+    try:
+        yield conn
+    finally:
+        await run_db(conn.close)
+
+def _cache_get(key: tuple) -> Optional[Any]:
+    """有効期間内のキャッシュ済みメタデータを取得"""
+    entry = _meta_cache.get(key)
+    if entry and time.monotonic() - entry[0] < META_CACHE_TTL:
+        return entry[1]
+    return None
+
+def _cache_set(key: tuple, value: Any, generation: int) -> Any:
+    """メタデータをキャッシュに保存
+    generation は取得を始める前に読んだ世代番号。取得中にキャッシュが破棄されていれば
+    古い内容の可能性があるので保存しない
+    """
+    if generation == _meta_cache_generation:
+        _meta_cache[key] = (time.monotonic(), value)
+    return value
+
+def _invalidate_meta_cache():
+    """テーブル構成が変わる操作の後にメタデータキャッシュを破棄"""
+    global _meta_cache_generation
+    _meta_cache_generation += 1
+    _meta_cache.clear()
+
+def _quote_ident(name: str) -> str:
+    """SQL識別子としてダブルクオートで囲む"""
+    return '"' + name.replace('"', '""') + '"'
+
+def _to_arrow_ipc(table: pa.Table) -> bytes:
+    """ArrowテーブルをIPCストリーム形式のバイト列に変換"""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def _fetch_table_rows(conn: duckdb.DuckDBPyConnection, table_name: str, limit: int, as_arrow: bool):
+    """テーブルの先頭 limit 行を取得（DB用スレッドで実行）
+    通常はArrowテーブルを返す。JSONで返す場合に、Arrowを経由すると値が変わる型の列があれば
+    DuckDBがPythonの値に変換した行（dictのリスト）を返す
+    """
+    result = conn.execute(f"SELECT * FROM {_quote_ident(table_name)} LIMIT ?", [limit])
+    if as_arrow or not any(_ARROW_JSON_UNSAFE_TYPE_RE.search(str(desc[1])) for desc in result.description):
+        return result.fetch_arrow_table()
+    columns = [desc[0] for desc in result.description]
+    return [dict(zip(columns, row)) for row in result.fetchall()]
 
-def get_db_connection():
-    """DuckDB接続を取得"""
-    return duckdb.connect(DB_PATH)
+def _quote_literal(value: str) -> str:
+    """SQL文字列リテラルとしてシングルクオートで囲む（パラメータを使えない文用）"""
+    return "'" + value.replace("'", "''") + "'"
 
 def import_duckdb_file(conn, temp_file_path):
     """DuckDBファイルをインポート"""
+    safe_path = temp_file_path.replace("'", "''")
+    # インポート元は読み取り専用でATTACHする（別接続は開かない）
+    conn.execute(f"ATTACH '{safe_path}' AS source_db (READ_ONLY)")
     try:
-        # インポート用の一時接続を作成
-        import_conn = duckdb.connect(temp_file_path)
-        
-        # インポート元のテーブル一覧を取得
-        tables = import_conn.execute("SHOW TABLES").fetchall()
-        
-        # 各テーブルをメインデータベースにコピー
-        for table in tables:
-            table_name = table[0]
-            # テーブル名を安全にエスケープ
-            safe_table_name = table_name.replace('"', '""')
-            
-            # テーブルが既に存在する場合は置き換え
-            conn.execute(f'DROP TABLE IF EXISTS "{safe_table_name}"')
-            
-            # テーブルをコピー（ATTACHを使用してより安全に）
-            try:
-                # まずATTACHでデータベースを接続
-                conn.execute(f"ATTACH '{temp_file_path}' AS source_db")
-                # テーブルをコピー
-                conn.execute(f'CREATE TABLE "{safe_table_name}" AS SELECT * FROM source_db."{safe_table_name}"')
-                # ATTACHを解除
-                conn.execute("DETACH source_db")
-            except Exception as e:
-                # ATTACHが失敗した場合は元の方法を試す
-                logger.warning(f"ATTACH method failed for table {table_name}, trying alternative method: {e}")
-                conn.execute(f'CREATE TABLE "{safe_table_name}" AS SELECT * FROM \'{temp_file_path}\'."{safe_table_name}"')
-            
-            # テーブルコメントをコピー
-            try:
-                table_comment = import_conn.execute(f"SELECT comment FROM duckdb_tables() WHERE table_name = '{table_name}'").fetchone()
-                if table_comment and table_comment[0]:
-                    # コメント内のシングルクォートをエスケープ
-                    safe_comment = table_comment[0].replace("'", "''")
-                    conn.execute(f'COMMENT ON TABLE "{safe_table_name}" IS \'{safe_comment}\'')
-            except Exception as e:
-                logger.warning(f"Failed to copy table comment for {table_name}: {e}")
-            
-            # カラムコメントをコピー
-            try:
-                column_comments = import_conn.execute(f"""
-                    SELECT column_name, comment 
-                    FROM duckdb_columns() 
-                    WHERE table_name = '{table_name}' AND comment IS NOT NULL
-                """).fetchall()
-                for column_name, comment in column_comments:
-                    # カラム名とコメントを安全にエスケープ
-                    safe_column_name = column_name.replace('"', '""')
-                    safe_comment = comment.replace("'", "''")
-                    conn.execute(f'COMMENT ON COLUMN "{safe_table_name}"."{safe_column_name}" IS \'{safe_comment}\'')
-            except Exception as e:
-                logger.warning(f"Failed to copy column comments for {table_name}: {e}")
-        
-        import_conn.close()
-        
+        try:
+            _copy_database(conn)
+        except Exception as e:
+            # COPY FROM DATABASE 非対応のバージョンなどではテーブルごとにコピー
+            logger.warning(f"COPY FROM DATABASE failed, copying tables one by one: {e}")
+            _copy_tables_one_by_one(conn)
     except Exception as e:
         logger.error(f"DuckDBファイルインポートエラー: {e}")
         raise e
+    finally:
+        conn.execute("DETACH source_db")
+
+def _copy_database(conn):
+    """COPY FROM DATABASE でテーブル・ビュー・コメントを一括コピー"""
+    target_db = conn.execute("SELECT current_database()").fetchone()[0]
+    # インポート元と同名のテーブル/ビューは置き換えるため先に削除する
+    conflicts = conn.execute("""
+        SELECT t.table_name, t.table_type
+        FROM information_schema.tables t
+        JOIN information_schema.tables s
+          ON s.table_name = t.table_name AND s.table_schema = t.table_schema
+        WHERE s.table_catalog = 'source_db' AND t.table_catalog = current_database()
+    """).fetchall()
+    conn.execute("BEGIN")
+    try:
+        for name, table_type in conflicts:
+            kind = "VIEW" if table_type == "VIEW" else "TABLE"
+            conn.execute(f'DROP {kind} IF EXISTS {_quote_ident(name)}')
+        conn.execute(f'COPY FROM DATABASE source_db TO {_quote_ident(target_db)}')
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def _copy_tables_one_by_one(conn):
+    """インポート元のテーブルを1つずつコピー（コメントも含む）"""
+    tables = conn.execute("""
+        SELECT table_name FROM information_schema.tables
+        WHERE table_catalog = 'source_db' AND table_schema = 'main'
+    """).fetchall()
+
+    # コメントはテーブルごとに問い合わせず、インポート元からまとめて取得
+    try:
+        table_comments = conn.execute("""
+            SELECT table_name, comment FROM duckdb_tables()
+            WHERE database_name = 'source_db' AND schema_name = 'main' AND comment IS NOT NULL
+        """).fetchall()
+        column_comments = conn.execute("""
+            SELECT table_name, column_name, comment FROM duckdb_columns()
+            WHERE database_name = 'source_db' AND schema_name = 'main' AND comment IS NOT NULL
+        """).fetchall()
+    except Exception as e:
+        logger.warning(f"Failed to read comments from source database: {e}")
+        table_comments, column_comments = [], []
+
+    # テーブルのコピーは1トランザクションで行う
+    conn.execute("BEGIN")
+    try:
+        for (table_name,) in tables:
+            # テーブルが既に存在する場合は置き換え
+            conn.execute(f'CREATE OR REPLACE TABLE {_quote_ident(table_name)} AS SELECT * FROM source_db.{_quote_ident(table_name)}')
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
 
-def _decode_with_fallbacks(content: bytes) -> str:
-    """Try multiple encodings to decode bytes to text.
-    Order: utf-8 -> cp932(Shift_JIS) -> utf-16-sig
+    # コメントはまとめて1トランザクションで適用する（失敗してもインポート自体は成功扱い）
+    statements = [
+        f'COMMENT ON TABLE {_quote_ident(table_name)} IS {_quote_literal(comment)}'
+        for table_name, comment in table_comments
+    ] + [
+        f'COMMENT ON COLUMN {_quote_ident(table_name)}.{_quote_ident(column_name)} IS {_quote_literal(comment)}'
+        for table_name, column_name, comment in column_comments
+    ]
+    if not statements:
+        return
+    conn.execute("BEGIN")
+    try:
+        for statement in statements:
+            conn.execute(statement)
+        conn.execute("COMMIT")
+    except Exception as e:
+        conn.execute("ROLLBACK")
+        logger.warning(f"Failed to copy comments from source database: {e}")
+
+def _detect_encoding(head: bytes) -> str:
+    """Detect the text encoding from the leading bytes of a file.
+    A UTF-16 BOM selects utf-16; otherwise the order is utf-8 -> cp932(Shift_JIS).
+    A multi-byte character cut off at the end of `head` is not treated as an error.
     """
-    for enc in ("utf-8", "cp932", "utf-16-sig"):
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    for enc in ("utf-8", "cp932"):
         try:
-            return content.decode(enc)
+            codecs.getincrementaldecoder(enc)().decode(head)
+            return enc
         except Exception:
             continue
-    raise UnicodeDecodeError("unknown", content, 0, 0, "Unsupported encoding. Save as UTF-8/Shift_JIS.")
+    raise UnicodeDecodeError("unknown", head, 0, 0, "Unsupported encoding. Save as UTF-8/Shift_JIS.")
+
+def _transcode_to_utf8(src, encoding: str, dest) -> None:
+    """Decode `src` chunk by chunk as `encoding` and write it to the binary file `dest` as UTF-8."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while chunk := src.read(UPLOAD_CHUNK_SIZE):
+        dest.write(decoder.decode(chunk).encode('utf-8'))
+    dest.write(decoder.decode(b'', final=True).encode('utf-8'))
+
+async def _transcode_upload(file: UploadFile, encoding: str):
+    """アップロードされたファイルをUTF-8に変換し、(DuckDBに読ませる入力, 一時ファイルのパス) を返す"""
+    try:
+        if file.size is not None and file.size <= IN_MEMORY_TRANSCODE_LIMIT:
+            # 小さいファイルはメモリ上でUTF-8に変換し、一時ファイルを介さずDuckDBに読ませる
+            buffer = io.BytesIO()
+            await asyncio.to_thread(_transcode_to_utf8, file.file, encoding, buffer)
+            buffer.seek(0)
+            return buffer, None
+        # 大きいファイルは少しずつUTF-8に変換しながら一時ファイルへ書き出す（全体をメモリに載せない）
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as temp_file:
+            try:
+                await asyncio.to_thread(_transcode_to_utf8, file.file, encoding, temp_file)
+            except Exception:
+                os.unlink(temp_file.name)
+                raise
+        return temp_file.name, temp_file.name
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="ファイルのエンコーディングを判定できませんでした。UTF-8 もしくは Shift_JIS(CP932) で保存してください。")
+
+def _create_table_from_csv(conn: duckdb.DuckDBPyConnection, table_name: str, source, **options):
+    """Create (or replace) a table from a CSV file object, letting DuckDB read it directly.
+    The whole file is sampled for type detection so that late rows do not break the sniffed schema.
+    """
+    conn.register("upload_src", conn.read_csv(source, parallel=True, sample_size=-1, **options))
+    try:
+        conn.execute(f'CREATE OR REPLACE TABLE {_quote_ident(table_name)} AS SELECT * FROM upload_src')
+    finally:
+        conn.unregister("upload_src")
+
+def _try_checkpoint(conn: duckdb.DuckDBPyConnection) -> None:
+    """WALに残っている変更をDBファイルへ書き出す（実行中の読み取りがあれば書き出しは諦める）"""
+    try:
+        conn.execute("CHECKPOINT")
+    except duckdb.Error as e:
+        logger.warning(f"CHECKPOINTに失敗しました: {e}")
+
+def _ingest_upload(conn: duckdb.DuckDBPyConnection, filename: str, original_table_name: str,
+                   table_name: str, safe_table_name: str, decoded_original: str,
+                   csv_source, temp_file_path: Optional[str]) -> Dict[str, Any]:
+    """アップロードされたファイルをテーブルとして取り込み、レスポンスを返す（DB用スレッドで実行）"""
+    # ファイル形式に応じて処理を分岐
+    if filename.endswith('.csv'):
+        _create_table_from_csv(conn, table_name, csv_source)
+    elif filename.endswith('.tsv'):
+        _create_table_from_csv(conn, table_name, csv_source, delimiter='\t')
+    elif filename.endswith('.duckdb'):
+        # DuckDBファイルのインポート処理
+        import_duckdb_file(conn, temp_file_path)
+        # DuckDBファイルの場合はテーブル数ではなく、インポートされたテーブル数を返す
+        imported_tables = conn.execute("SHOW TABLES").fetch_arrow_table().column(0).to_pylist()
+        app.state.table_names = set(imported_tables)
+        _try_checkpoint(conn)
+        return {
+            "message": f"DuckDBファイル '{filename}' が正常にインポートされました",
+            "table_name": "imported_database",
+            "original_table_name": original_table_name,
+            "row_count": len(imported_tables),
+            "imported_tables": imported_tables
+        }
+    else:
+        raise HTTPException(status_code=400, detail="CSV、TSV、またはDuckDBファイルのみサポートしています")
+
+    # 必要なら仮の安全なテーブル名にリネームし、元名をコメントとして保持
+    if safe_table_name != table_name:
+        conn.execute(f'ALTER TABLE {_quote_ident(table_name)} RENAME TO {_quote_ident(safe_table_name)}')
+        # コメントに元の表示名を残す
+        conn.execute(f"COMMENT ON TABLE {_quote_ident(safe_table_name)} IS {_quote_literal(decoded_original)}")
+        table_name = safe_table_name
+
+    # テーブル情報を取得（行数/カラム数のバリデーションを1クエリで行う）
+    [(row_count, column_count)] = conn.execute(f"""
+        SELECT (SELECT COUNT(*) FROM {_quote_ident(table_name)}),
+               (SELECT COUNT(*) FROM (DESCRIBE {_quote_ident(table_name)}))
+    """).fetchall()
+
+    if column_count == 0:
+        # 後片付けしてエラー返却
+        conn.execute(f"DROP TABLE IF EXISTS {_quote_ident(table_name)}")
+        raise HTTPException(status_code=400, detail="アップロードに失敗しました。カラムが検出できませんでした（区切り文字やエンコーディングをご確認ください）。")
+
+    if row_count == 0:
+        conn.execute(f"DROP TABLE IF EXISTS {_quote_ident(table_name)}")
+        raise HTTPException(status_code=400, detail="アップロードに失敗しました。データ行が検出できませんでした（ヘッダーのみ、または空ファイルの可能性）。")
+
+    app.state.table_names.add(table_name)
+    _try_checkpoint(conn)
+
+    return {
+        "message": f"ファイル '{filename}' が正常にアップロードされました",
+        "table_name": table_name,
+        "original_table_name": original_table_name,
+        "row_count": row_count
+    }
+
+def _load_table_names(conn: duckdb.DuckDBPyConnection) -> set:
+    """SHOW TABLES からテーブル名の集合を作る"""
+    return {row[0] for row in conn.execute("SHOW TABLES").fetchall()}
+
+@lru_cache(maxsize=4096)
+def _name_candidates(path_name: str) -> tuple:
+    """Candidate table names for a path segment: as-is, URL-decoded and URL-encoded."""
+    return (
+        path_name,
+        urllib.parse.unquote(path_name),
+        urllib.parse.quote(path_name, safe='')
+    )
 
-def _resolve_table_name(conn: duckdb.DuckDBPyConnection, path_name: str) -> str:
+async def _resolve_table_name(conn: duckdb.DuckDBPyConnection, path_name: str) -> str:
     """Resolve an incoming path table name (which may be URL-encoded or not)
     to an existing table name in DuckDB. Returns the matched name or raises HTTP 404.
+    Names are looked up in the in-memory table name set; on a miss the set is
+    reloaded from SHOW TABLES (on the DuckDB executor) once before giving up.
     """
+    # そのまま一致する一般的なケースは文字列変換なしで返す
+    if path_name in app.state.table_names:
+        return path_name
+
+    candidates = _name_candidates(path_name)
+    for cand in candidates:
+        if cand in app.state.table_names:
+            return cand
+
     try:
-        existing = {row[0] for row in conn.execute("SHOW TABLES").fetchall()}
+        existing = await run_db(_load_table_names, conn)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"テーブル一覧取得エラー: {str(e)}")
+    app.state.table_names = existing
 
-    candidates = [
-        path_name,
-        urllib.parse.unquote(path_name),
-        urllib.parse.quote(path_name, safe='')
-    ]
     for cand in candidates:
         if cand in existing:
             return cand
@@ -145,30 +471,23 @@ async def root(request: Request):
 @app.get("/table/{table_name}", response_class=HTMLResponse)
 async def view_table_page(request: Request, table_name: str):
     """テーブル表示専用ページ"""
-    display_name = urllib.parse.unquote(table_name)
     return templates.TemplateResponse("table_view.html", {
         "request": request,
-        "table_name": table_name,
-        "display_name": display_name
+        "table_name": table_name
     })
 
 @app.get("/table/{table_name}/edit", response_class=HTMLResponse)
 async def edit_table_page(request: Request, table_name: str):
     """テーブル定義編集専用ページ"""
-    display_name = urllib.parse.unquote(table_name)
     return templates.TemplateResponse("table_edit.html", {
         "request": request,
-        "table_name": table_name,
-        "display_name": display_name
+        "table_name": table_name
     })
 
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
     """CSV/TSVファイルをアップロードしてDuckDBに保存"""
     try:
-        # ファイル内容を読み込み
-        content = await file.read()
-        
         # テーブル名を生成（ファイル名から拡張子を除く）
         original_table_name = Path(file.filename).stem
         table_name = urllib.parse.quote(original_table_name, safe='')
@@ -183,82 +502,55 @@ async def upload_file(file: UploadFile = File(...)):
         rename_to_safe = _needs_safe_name(decoded_original)
         safe_table_name = f"table_{int(time.time())}" if rename_to_safe else table_name
         
-        # DuckDBに接続してテーブルを作成
-        conn = get_db_connection()
-        
-        # ファイル形式に応じて一時ファイルを作成
+        # ファイル形式に応じて読み込み元を用意
+        temp_file_path = None
+        csv_source = None
+        encoding = None
         if file.filename.endswith('.duckdb'):
-            # DuckDBファイルはバイナリなので直接保存
+            # ATTACHにはファイルパスが必要なため一時ファイルに保存
             with tempfile.NamedTemporaryFile(delete=False, suffix='.duckdb') as temp_file:
-                temp_file.write(content)
+                await asyncio.to_thread(shutil.copyfileobj, file.file, temp_file, UPLOAD_CHUNK_SIZE)
                 temp_file_path = temp_file.name
         else:
-            # CSV/TSVファイルはテキストとして保存（エンコーディング自動判定）
+            # CSV/TSVファイルは先頭部分だけでエンコーディングを判定
+            head = file.file.read(ENCODING_SNIFF_SIZE)
+            file.file.seek(0)
             try:
-                content_str = _decode_with_fallbacks(content)
+                encoding = _detect_encoding(head)
             except UnicodeDecodeError:
                 raise HTTPException(status_code=400, detail="ファイルのエンコーディングを判定できませんでした。UTF-8 もしくは Shift_JIS(CP932) で保存してください。")
 
-            with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', suffix='.csv', delete=False) as temp_file:
-                temp_file.write(content_str)
-                temp_file_path = temp_file.name
-        
-        try:
-            # ファイル形式に応じて処理を分岐
-            if file.filename.endswith('.csv'):
-                conn.execute(f"CREATE OR REPLACE TABLE \"{table_name}\" AS SELECT * FROM read_csv_auto('{temp_file_path}')")
-            elif file.filename.endswith('.tsv'):
-                conn.execute(f"CREATE OR REPLACE TABLE \"{table_name}\" AS SELECT * FROM read_csv_auto('{temp_file_path}', delim='\\t')")
-            elif file.filename.endswith('.duckdb'):
-                # DuckDBファイルのインポート処理
-                import_duckdb_file(conn, temp_file_path)
-                # DuckDBファイルの場合はテーブル数ではなく、インポートされたテーブル数を返す
-                tables_result = conn.execute("SHOW TABLES").fetchall()
-                return {
-                    "message": f"DuckDBファイル '{file.filename}' が正常にインポートされました",
-                    "table_name": "imported_database",
-                    "original_table_name": original_table_name,
-                    "row_count": len(tables_result),
-                    "imported_tables": [table[0] for table in tables_result]
-                }
+            if encoding == "utf-8":
+                # UTF-8はアップロードされたファイルをそのままDuckDBに読ませる
+                csv_source = file.file
             else:
-                raise HTTPException(status_code=400, detail="CSV、TSV、またはDuckDBファイルのみサポートしています")
-            
-            # 必要なら仮の安全なテーブル名にリネームし、元名をコメントとして保持
-            if rename_to_safe and safe_table_name != table_name:
-                conn.execute(f'ALTER TABLE "{table_name}" RENAME TO "{safe_table_name}"')
-                # コメントに元の表示名を残す
-                safe_comment = decoded_original.replace("'", "''")
-                conn.execute(f"COMMENT ON TABLE \"{safe_table_name}\" IS '{safe_comment}'")
-                table_name = safe_table_name
-            
-            # テーブル情報を取得（行数/カラム数のバリデーション）
-            result = conn.execute(f"SELECT COUNT(*) as count FROM \"{table_name}\"").fetchone()
-            schema_rows = conn.execute(f"DESCRIBE \"{table_name}\"").fetchall()
-            row_count = int(result[0]) if result and result[0] is not None else 0
-            column_count = len(schema_rows)
-
-            if column_count == 0:
-                # 後片付けしてエラー返却
-                conn.execute(f"DROP TABLE IF EXISTS \"{table_name}\"")
-                raise HTTPException(status_code=400, detail="アップロードに失敗しました。カラムが検出できませんでした（区切り文字やエンコーディングをご確認ください）。")
-
-            if row_count == 0:
-                conn.execute(f"DROP TABLE IF EXISTS \"{table_name}\"")
-                raise HTTPException(status_code=400, detail="アップロードに失敗しました。データ行が検出できませんでした（ヘッダーのみ、または空ファイルの可能性）。")
-            
-        finally:
-            # 一時ファイルを削除
-            os.unlink(temp_file_path)
+                csv_source, temp_file_path = await _transcode_upload(file, encoding)
         
-        conn.close()
+        async def ingest():
+            # DuckDBに接続してテーブルを作成
+            async with open_db() as conn:
+                return await run_db(
+                    _ingest_upload, conn, file.filename, original_table_name, table_name,
+                    safe_table_name, decoded_original, csv_source, temp_file_path
+                )
         
-        return {
-            "message": f"ファイル '{file.filename}' が正常にアップロードされました",
-            "table_name": table_name,
-            "original_table_name": original_table_name,
-            "row_count": row_count
-        }
+        async with _write_lock:
+            try:
+                try:
+                    return await ingest()
+                except duckdb.InvalidInputException as e:
+                    # 先頭部分はASCIIのみでUTF-8と判定されても、後半にShift_JISの文字が含まれていることがある
+                    if encoding != "utf-8" or "unicode" not in str(e).lower():
+                        raise
+                    logger.warning(f"UTF-8として読み込めなかったため、CP932として読み直します: {str(e).splitlines()[0]}")
+                    file.file.seek(0)
+                    csv_source, temp_file_path = await _transcode_upload(file, "cp932")
+                    return await ingest()
+            finally:
+                # 一時ファイルを削除
+                if temp_file_path:
+                    os.unlink(temp_file_path)
+                _invalidate_meta_cache()
         
     except Exception as e:
         logger.error(f"ファイルアップロードエラー: {e}")
@@ -268,41 +560,48 @@ async def upload_file(file: UploadFile = File(...)):
 async def list_tables():
     """利用可能なAIが参照できるデータ一覧を取得"""
     try:
-        conn = get_db_connection()
-        result = conn.execute("SHOW TABLES").fetchall()
-        conn.close()
+        cached = _cache_get(("tables",))
+        if cached is not None:
+            return cached
         
-        tables = []
-        for row in result:
-            table_name = row[0]
-            try:
-                display_name = urllib.parse.unquote(table_name)
-            except:
-                display_name = table_name
-            
-            tables.append({
-                "name": table_name,
-                "display_name": display_name
-            })
+        generation = _meta_cache_generation
+        async with open_db() as conn:
+            result = await run_db(lambda: conn.execute("SHOW TABLES").fetchall())
+        # 一覧を取り直したついでにテーブル名の集合も更新しておく（取得中に構成が変わっていれば古いので使わない）
+        if generation == _meta_cache_generation:
+            app.state.table_names = {row[0] for row in result}
+        
+        # '%' を含まない名前は unquote しても変わらないのでそのまま使う
+        tables = [
+            {"name": n, "display_name": urllib.parse.unquote(n) if "%" in n else n}
+            for (n,) in result
+        ]
         
-        return {"tables": tables}
+        return _cache_set(("tables",), {"tables": tables}, generation)
         
     except Exception as e:
         logger.error(f"AIが参照できるデータ一覧取得エラー: {e}")
         raise HTTPException(status_code=500, detail=f"エラー: {str(e)}")
 
 @app.get("/query/{table_name}")
-async def query_table(table_name: str, limit: int = 10):
+async def query_table(request: Request, table_name: str, limit: int = 10):
     """テーブルのデータをクエリ"""
     try:
-        conn = get_db_connection()
-        resolved = _resolve_table_name(conn, table_name)
-        result = conn.execute(f"SELECT * FROM \"{resolved}\" LIMIT {limit}").fetchall()
-        columns = [desc[0] for desc in conn.description]
-        conn.close()
+        # Arrowを受け取れるクライアントにはJSONを介さずIPCストリームで返す
+        as_arrow = ARROW_STREAM_MEDIA_TYPE in request.headers.get("accept", "")
+        async with open_db() as conn:
+            resolved = await _resolve_table_name(conn, table_name)
+            rows = await run_db(_fetch_table_rows, conn, resolved, limit, as_arrow)
+        
+        if as_arrow:
+            return Response(content=_to_arrow_ipc(rows), media_type=ARROW_STREAM_MEDIA_TYPE)
         
-        data = [dict(zip(columns, row)) for row in result]
-        return {"table": resolved, "data": data, "limit": limit}
+        if isinstance(rows, pa.Table):
+            # Arrow経由で行ごとのdictに変換する
+            return ORJSONResponse({"table": resolved, "data": rows.to_pylist(), "limit": limit})
+        
+        # 64bitを超える整数はorjsonで扱えないため、標準のJSONエンコーダで返す
+        return JSONResponse(jsonable_encoder({"table": resolved, "data": rows, "limit": limit}))
         
     except Exception as e:
         logger.error(f"クエリエラー: {e}")
@@ -312,13 +611,17 @@ async def query_table(table_name: str, limit: int = 10):
 async def get_table_schema(table_name: str):
     """テーブルのスキーマ情報を取得"""
     try:
-        conn = get_db_connection()
-        resolved = _resolve_table_name(conn, table_name)
-        result = conn.execute(f"DESCRIBE \"{resolved}\"").fetchall()
-        conn.close()
+        cached = _cache_get(("schema", table_name))
+        if cached is not None:
+            return cached
+        
+        generation = _meta_cache_generation
+        async with open_db() as conn:
+            resolved = await _resolve_table_name(conn, table_name)
+            result = await run_db(lambda: conn.execute(f"DESCRIBE {_quote_ident(resolved)}").fetchall())
         
         schema = [{"column": row[0], "type": row[1], "null": row[2], "key": row[3], "default": row[4], "extra": row[5]} for row in result]
-        return {"table": resolved, "schema": schema}
+        return _cache_set(("schema", table_name), {"table": resolved, "schema": schema}, generation)
         
     except Exception as e:
         logger.error(f"スキーマ取得エラー: {e}")
@@ -328,9 +631,10 @@ async def get_table_schema(table_name: str):
 async def update_column_name(table_name: str, column_name: str, new_name: str):
     """カラム名を変更"""
     try:
-        conn = get_db_connection()
-        conn.execute(f"ALTER TABLE \"{table_name}\" RENAME COLUMN {column_name} TO {new_name}")
-        conn.close()
+        async with _write_lock, open_db() as conn:
+            resolved = await _resolve_table_name(conn, table_name)
+            await run_db(conn.execute, f"ALTER TABLE {_quote_ident(resolved)} RENAME COLUMN {_quote_ident(column_name)} TO {_quote_ident(new_name)}")
+            _invalidate_meta_cache()
         
         return {"message": f"カラム '{column_name}' を '{new_name}' に変更しました"}
         
@@ -342,21 +646,21 @@ async def update_column_name(table_name: str, column_name: str, new_name: str):
 async def rename_table(table_name: str, new_name: str = Body(..., embed=True)):
     """テーブル名を変更する"""
     try:
-        conn = get_db_connection()
-        # 現在の実テーブル名を解決
-        resolved = _resolve_table_name(conn, table_name)
-
-        # 既存衝突チェック
-        exists = conn.execute("SHOW TABLES").fetchall()
-        existing_names = {row[0] for row in exists}
-        # 目標名はURLエンコードせず、そのまま識別子として扱う（必ずクオートする）
-        if new_name in existing_names:
-            conn.close()
-            raise HTTPException(status_code=400, detail="同名のテーブルが既に存在します")
-
-        # リネーム
-        conn.execute(f'ALTER TABLE "{resolved}" RENAME TO "{new_name}"')
-        conn.close()
+        async with _write_lock, open_db() as conn:
+            # 現在の実テーブル名を解決
+            resolved = await _resolve_table_name(conn, table_name)
+
+            # 既存衝突チェック
+            # 目標名はURLエンコードせず、そのまま識別子として扱う（必ずクオートする）
+            exists = await run_db(lambda: conn.execute("SELECT 1 FROM (SHOW TABLES) WHERE name = ?", [new_name]).fetchone())
+            if exists:
+                raise HTTPException(status_code=400, detail="同名のテーブルが既に存在します")
+
+            # リネーム
+            await run_db(conn.execute, f'ALTER TABLE {_quote_ident(resolved)} RENAME TO {_quote_ident(new_name)}')
+            app.state.table_names.discard(resolved)
+            app.state.table_names.add(new_name)
+            _invalidate_meta_cache()
 
         return {"message": "テーブル名を変更しました", "old": resolved, "new": new_name}
 
@@ -370,47 +674,42 @@ async def rename_table(table_name: str, new_name: str = Body(..., embed=True)):
 async def get_table_metadata(table_name: str):
     """テーブルのメタデータを取得"""
     try:
-        conn = get_db_connection()
-        resolved = _resolve_table_name(conn, table_name)
-        
-        # テーブル情報を取得
-        result = conn.execute(f"SELECT COUNT(*) FROM \"{resolved}\"").fetchone()
-        row_count = result[0]
-        
-        # スキーマ情報を取得
-        schema_result = conn.execute(f"DESCRIBE \"{resolved}\"").fetchall()
-        columns = [{"name": row[0], "type": row[1]} for row in schema_result]
-        
-        # テーブルコメントを取得
-        try:
-            table_comment_result = conn.execute(f"SELECT comment FROM duckdb_tables() WHERE table_name = '{resolved}'").fetchone()
-            table_comment = table_comment_result[0] if table_comment_result and table_comment_result[0] else ""
-        except:
-            table_comment = ""
-        
-        # カラムコメントを取得
-        try:
-            column_comments_result = conn.execute(f"""
-                SELECT column_name, comment 
-                FROM duckdb_columns() 
-                WHERE table_name = '{resolved}' AND comment IS NOT NULL
-            """).fetchall()
-            column_comments = {row[0]: row[1] for row in column_comments_result}
-        except:
-            column_comments = {}
-        
-        # カラム情報にコメントを追加
+        cached = _cache_get(("metadata", table_name))
+        if cached is not None:
+            return cached
+        
+        generation = _meta_cache_generation
+        async with open_db() as conn:
+            resolved = await _resolve_table_name(conn, table_name)
+        
+            # 行数・テーブルコメント・カラム情報（コメント込み）を1クエリで取得
+            # fetchoneだと結果が開いたままでトランザクションが残りCHECKPOINTを妨げるため、1行でも読み切る
+            [(row_count, table_comment, columns)] = await run_db(lambda: conn.execute(f"""
+                SELECT
+                    (SELECT COUNT(*) FROM {_quote_ident(resolved)}),
+                    (SELECT comment FROM duckdb_tables()
+                      WHERE database_name = current_database()
+                        AND schema_name = current_schema()
+                        AND table_name = ?),
+                    list(struct_pack(name := column_name, type := data_type, comment := comment)
+                         ORDER BY column_index)
+                FROM duckdb_columns()
+                WHERE database_name = current_database()
+                  AND schema_name = current_schema()
+                  AND table_name = ?
+            """, [resolved, resolved]).fetchall())
+        
+        columns = columns or []
         for column in columns:
-            column["comment"] = column_comments.get(column["name"], "")
+            column["comment"] = column["comment"] or ""
+        table_comment = table_comment or ""
         
-        conn.close()
-        
-        return {
+        return _cache_set(("metadata", table_name), {
             "table": resolved,
             "row_count": row_count,
             "table_comment": table_comment,
             "columns": columns
-        }
+        }, generation)
         
     except Exception as e:
         logger.error(f"メタデータ取得エラー: {e}")
@@ -420,9 +719,11 @@ async def get_table_metadata(table_name: str):
 async def update_table_comment(table_name: str, comment: str):
     """テーブルのコメントを更新"""
     try:
-        conn = get_db_connection()
-        conn.execute(f"COMMENT ON TABLE \"{table_name}\" IS '{comment}'")
-        conn.close()
+        async with _write_lock, open_db() as conn:
+            resolved = await _resolve_table_name(conn, table_name)
+            # COMMENT ON は値のバインドに対応していないため、識別子・リテラルとしてエスケープする
+            await run_db(conn.execute, f"COMMENT ON TABLE {_quote_ident(resolved)} IS {_quote_literal(comment)}")
+            _invalidate_meta_cache()
         
         return {"message": f"テーブル '{table_name}' のコメントを更新しました", "comment": comment}
         
@@ -434,9 +735,11 @@ async def update_table_comment(table_name: str, comment: str):
 async def update_column_comment(table_name: str, column_name: str, comment: str):
     """カラムのコメントを更新"""
     try:
-        conn = get_db_connection()
-        conn.execute(f"COMMENT ON COLUMN \"{table_name}\".{column_name} IS '{comment}'")
-        conn.close()
+        async with _write_lock, open_db() as conn:
+            resolved = await _resolve_table_name(conn, table_name)
+            # COMMENT ON は値のバインドに対応していないため、識別子・リテラルとしてエスケープする
+            await run_db(conn.execute, f"COMMENT ON COLUMN {_quote_ident(resolved)}.{_quote_ident(column_name)} IS {_quote_literal(comment)}")
+            _invalidate_meta_cache()
         
         return {"message": f"カラム '{column_name}' のコメントを更新しました", "comment": comment}
         
@@ -448,10 +751,11 @@ async def update_column_comment(table_name: str, column_name: str, comment: str)
 async def delete_table(table_name: str):
     """テーブルを削除"""
     try:
-        conn = get_db_connection()
-        resolved = _resolve_table_name(conn, table_name)
-        conn.execute(f"DROP TABLE IF EXISTS \"{resolved}\"")
-        conn.close()
+        async with _write_lock, open_db() as conn:
+            resolved = await _resolve_table_name(conn, table_name)
+            await run_db(conn.execute, f"DROP TABLE IF EXISTS {_quote_ident(resolved)}")
+            app.state.table_names.discard(resolved)
+            _invalidate_meta_cache()
         
         return {"message": f"テーブル '{resolved}' を削除しました"}
         
@@ -463,21 +767,30 @@ async def delete_table(table_name: str):
 async def download_database():
     """DuckDBデータベースファイルをダウンロード"""
     try:
-        # データベースファイルが存在するかチェック
-        if not os.path.exists(DB_PATH):
-            raise HTTPException(status_code=404, detail="データベースファイルが見つかりません")
+        # WALに残っている変更をDBファイルへ書き出してから返す
+        async with _write_lock:
+            try:
+                async with open_db() as conn:
+                    await run_db(_try_checkpoint, conn)
+            except duckdb.Error as e:
+                logger.warning(f"ダウンロード前にDBファイルを開けませんでした: {e}")
         
-        # ファイルサイズを取得
-        file_size = os.path.getsize(DB_PATH)
+        # データベースファイルの存在確認とサイズ取得を1回のstatで行う
+        try:
+            stat_result = os.stat(DB_PATH)
+        except FileNotFoundError:
+            raise HTTPException(status_code=404, detail="データベースファイルが見つかりません")
         
-        # ファイルレスポンスを返す
+        # ファイルレスポンスを返す（stat_resultを渡してRangeリクエストにも対応させる）
         return FileResponse(
             path=DB_PATH,
             filename="database.duckdb",
             media_type="application/octet-stream",
-            headers={"Content-Disposition": "attachment; filename=database.duckdb"}
+            stat_result=stat_result
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"データベースダウンロードエラー: {e}")
         raise HTTPException(status_code=500, detail=f"ダウンロードエラー: {str(e)}")
@@ -488,4 +801,5 @@ if __name__ == "__main__":
     Path("/app/logs").mkdir(exist_ok=True)
     
     logger.info("Local DB MCP Server を起動中...")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # DuckDBのファイルロックは1プロセスしか持てないため、ワーカーは1つのままuvloop/httptoolsで高速化する
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools", timeout_keep_alive=30)
@@ -7,9 +7,11 @@ MCP Server with DuckDB
 import asyncio
 import json
 import logging
+import re
 import urllib.parse
 import tempfile
 import os
+import shutil
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
@@ -36,7 +38,21 @@ DB_PATH = "/app/data/database.duckdb"
 
 def get_db_connection():
     """DuckDB接続を取得"""
-    return duckdb.connect(DB_PATH)
+    # CSV読み込みなどを全コアで並列実行し、サーバーでは不要な進捗表示は切る
+    conn = duckdb.connect(DB_PATH, config={"threads": os.cpu_count() or 1})
+    conn.execute("PRAGMA disable_progress_bar")
+    return conn
+
+# Arrowを経由するとJSONの値が fetchall() と変わってしまう型（HUGEINT/UHUGEINTの桁あふれ、INTERVAL・MAPなどの表現の違い）
+_ARROW_JSON_UNSAFE_TYPE_RE = re.compile(r"\b(U?HUGEINT|INTERVAL|MAP|BIT|UNION|BIGNUM|VARINT)\b")
+
+def _quote_ident(name: str) -> str:
+    """SQL識別子としてダブルクオートで囲む"""
+    return '"' + name.replace('"', '""') + '"'
+
+def _quote_literal(value: str) -> str:
+    """SQL文字列リテラルとしてシングルクオートで囲む（パラメータを使えない文用）"""
+    return "'" + value.replace("'", "''") + "'"
 
 @app.get("/health")
 async def health_check():
@@ -72,10 +88,6 @@ async def edit_table_page(request: Request, table_name: str):
 async def upload_file(file: UploadFile = File(...)):
     """CSV/TSVファイルをアップロードしてDuckDBに保存"""
     try:
-        # ファイル内容を読み込み
-        content = await file.read()
-        content_str = content.decode('utf-8')
-        
         # テーブル名を生成（ファイル名から拡張子を除く）
         original_table_name = Path(file.filename).stem
         table_name = urllib.parse.quote(original_table_name, safe='')
@@ -83,22 +95,22 @@ async def upload_file(file: UploadFile = File(...)):
         # DuckDBに接続してテーブルを作成
         conn = get_db_connection()
         
-        # 一時ファイルを作成してDuckDBで読み込み
-        with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', suffix='.csv', delete=False) as temp_file:
-            temp_file.write(content_str)
+        # アップロード内容を一時ファイルへ少しずつコピーしてDuckDBで読み込み（全体をメモリに載せない）
+        with tempfile.NamedTemporaryFile(suffix='.csv', delete=False) as temp_file:
+            shutil.copyfileobj(file.file, temp_file, 1 << 20)
             temp_file_path = temp_file.name
         
         try:
             # CSV/TSVをテーブルとして読み込み
             if file.filename.endswith('.csv'):
-                conn.execute(f"CREATE OR REPLACE TABLE \"{table_name}\" AS SELECT * FROM read_csv_auto('{temp_file_path}')")
+                conn.execute(f"CREATE OR REPLACE TABLE {_quote_ident(table_name)} AS SELECT * FROM read_csv_auto(?, sample_size=-1)", [temp_file_path])
             elif file.filename.endswith('.tsv'):
-                conn.execute(f"CREATE OR REPLACE TABLE \"{table_name}\" AS SELECT * FROM read_csv_auto('{temp_file_path}', delim='\\t')")
+                conn.execute(f"CREATE OR REPLACE TABLE {_quote_ident(table_name)} AS SELECT * FROM read_csv_auto(?, delim='\\t', sample_size=-1)", [temp_file_path])
             else:
                 raise HTTPException(status_code=400, detail="CSVまたはTSVファイルのみサポートしています")
             
             # テーブル情報を取得
-            result = conn.execute(f"SELECT COUNT(*) as count FROM \"{table_name}\"").fetchone()
+            result = conn.execute(f"SELECT COUNT(*) as count FROM {_quote_ident(table_name)}").fetchone()
             
         finally:
             # 一時ファイルを削除
@@ -149,11 +161,16 @@ async def query_table(table_name: str, limit: int = 10):
     """テーブルのデータをクエリ"""
     try:
         conn = get_db_connection()
-        result = conn.execute(f"SELECT * FROM \"{table_name}\" LIMIT {limit}").fetchall()
-        columns = [desc[0] for desc in conn.description]
+        result = conn.execute(f"SELECT * FROM {_quote_ident(table_name)} LIMIT ?", [limit])
+        if any(_ARROW_JSON_UNSAFE_TYPE_RE.search(str(desc[1])) for desc in result.description):
+            # Arrowでは値が変わる型を含む場合はDuckDBがPythonの値に変換した行を使う
+            columns = [desc[0] for desc in result.description]
+            data = [dict(zip(columns, row)) for row in result.fetchall()]
+        else:
+            # Arrow経由で行ごとのdictに変換する
+            data = result.fetch_arrow_table().to_pylist()
         conn.close()
         
-        data = [dict(zip(columns, row)) for row in result]
         return {"table": table_name, "data": data, "limit": limit}
         
     except Exception as e:
@@ -165,7 +182,7 @@ async def get_table_schema(table_name: str):
     """テーブルのスキーマ情報を取得"""
     try:
         conn = get_db_connection()
-        result = conn.execute(f"DESCRIBE \"{table_name}\"").fetchall()
+        result = conn.execute(f"DESCRIBE {_quote_ident(table_name)}").fetchall()
         conn.close()
         
         schema = [{"column": row[0], "type": row[1], "null": row[2], "key": row[3], "default": row[4], "extra": row[5]} for row in result]
@@ -180,7 +197,7 @@ async def update_column_name(table_name: str, column_name: str, new_name: str):
     """カラム名を変更"""
     try:
         conn = get_db_connection()
-        conn.execute(f"ALTER TABLE \"{table_name}\" RENAME COLUMN {column_name} TO {new_name}")
+        conn.execute(f"ALTER TABLE {_quote_ident(table_name)} RENAME COLUMN {_quote_ident(column_name)} TO {_quote_ident(new_name)}")
         conn.close()
         
         return {"message": f"カラム '{column_name}' を '{new_name}' に変更しました"}
@@ -195,35 +212,21 @@ async def get_table_metadata(table_name: str):
     try:
         conn = get_db_connection()
         
-        # テーブル情報を取得
-        result = conn.execute(f"SELECT COUNT(*) FROM \"{table_name}\"").fetchone()
-        row_count = result[0]
-        
-        # スキーマ情報を取得
-        schema_result = conn.execute(f"DESCRIBE \"{table_name}\"").fetchall()
-        columns = [{"name": row[0], "type": row[1]} for row in schema_result]
-        
-        # テーブルコメントを取得
-        try:
-            table_comment_result = conn.execute(f"SELECT comment FROM duckdb_tables() WHERE table_name = '{table_name}'").fetchone()
-            table_comment = table_comment_result[0] if table_comment_result and table_comment_result[0] else ""
-        except:
-            table_comment = ""
-        
-        # カラムコメントを取得
-        try:
-            column_comments_result = conn.execute(f"""
-                SELECT column_name, comment 
-                FROM duckdb_columns() 
-                WHERE table_name = '{table_name}' AND comment IS NOT NULL
-            """).fetchall()
-            column_comments = {row[0]: row[1] for row in column_comments_result}
-        except:
-            column_comments = {}
+        # 行数・テーブルコメント・カラム情報（コメント込み）を1クエリで取得
+        row_count, table_comment, columns = conn.execute(f"""
+            SELECT
+                (SELECT COUNT(*) FROM {_quote_ident(table_name)}),
+                (SELECT comment FROM duckdb_tables() WHERE table_name = ?),
+                list(struct_pack(name := column_name, type := data_type, comment := comment)
+                     ORDER BY column_index)
+            FROM duckdb_columns()
+            WHERE table_name = ?
+        """, [table_name, table_name]).fetchone()
         
-        # カラム情報にコメントを追加
+        columns = columns or []
         for column in columns:
-            column["comment"] = column_comments.get(column["name"], "")
+            column["comment"] = column["comment"] or ""
+        table_comment = table_comment or ""
         
         conn.close()
         
@@ -243,7 +246,7 @@ async def update_table_comment(table_name: str, comment: str):
     """テーブルのコメントを更新"""
     try:
         conn = get_db_connection()
-        conn.execute(f"COMMENT ON TABLE \"{table_name}\" IS '{comment}'")
+        conn.execute(f"COMMENT ON TABLE {_quote_ident(table_name)} IS {_quote_literal(comment)}")
         conn.close()
         
         return {"message": f"テーブル '{table_name}' のコメントを更新しました", "comment": comment}
@@ -257,7 +260,7 @@ async def update_column_comment(table_name: str, column_name: str, comment: str)
     """カラムのコメントを更新"""
     try:
         conn = get_db_connection()
-        conn.execute(f"COMMENT ON COLUMN \"{table_name}\".{column_name} IS '{comment}'")
+        conn.execute(f"COMMENT ON COLUMN {_quote_ident(table_name)}.{_quote_ident(column_name)} IS {_quote_literal(comment)}")
         conn.close()
         
         return {"message": f"カラム '{column_name}' のコメントを更新しました", "comment": comment}
@@ -272,4 +275,5 @@ if __name__ == "__main__":
     Path("/app/logs").mkdir(exist_ok=True)
     
     logger.info("Local DB MCP Server を起動中...")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # DuckDBのファイルロックは1プロセスしか持てないため、ワーカーは1つのままuvloop/httptoolsで高速化する
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools", timeout_keep_alive=30)